@@ -3,15 +3,28 @@ import pandas as pd
 import numpy as np
 import io
 import os
-import altair as alt
+import re
+import hashlib
+import hmac
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # Librerías Geoespaciales
-import geopandas as gpd
-from shapely.ops import linemerge
-from shapely.geometry import LineString, MultiLineString
-from pyproj import Transformer
-from sklearn.linear_model import LinearRegression
+# geopandas y pyproj se importan dentro de las funciones del ducto: solo se cargan
+# la primera vez que se procesa un archivo con georreferencia, no al abrir la app.
+import shapely
+
+# Aceleradores opcionales: si numba o bottleneck no están instalados se usa pandas
+try:
+    from fast_filters import limpiar_senal, proyectar_en_segmentos
+except ImportError:
+    limpiar_senal = None
+    proyectar_en_segmentos = None
+
+try:
+    import bottleneck as bn
+except ImportError:
+    bn = None
 
 # =========================================================
 #  NUEVA FUNCIÓN: SUBIDA A SHAREPOINT
@@ -73,10 +86,15 @@ def generar_nombre_archivo(distrito, ramal):
 st.set_page_config(page_title="Portal Ingeniería CIPS", page_icon="🔒", layout="wide")
 
 # --- 2. SISTEMA DE SEGURIDAD (LOGIN) ---
+# SHA-256 de la clave de acceso (la clave no queda en texto plano en el código)
+HASH_CLAVE = bytes.fromhex("06b7fe291cf63d757d03fe4e0bd8b7831b7b7d763ca0317bcaa4e3e9c9c36613")
+
 def check_password():
     """Retorna True si el usuario ingresó la clave correcta."""
     def password_entered():
-        if st.session_state["password"] == "CIPS2026":
+        hash_ingresado = hashlib.sha256(st.session_state["password"].encode("utf-8")).digest()
+        # Comparación en tiempo constante
+        if hmac.compare_digest(hash_ingresado, HASH_CLAVE):
             st.session_state["password_correct"] = True
             del st.session_state["password"]
         else:
@@ -109,10 +127,11 @@ if not check_password():
 # =========================================================
 
 @st.cache_data
-def cargar_mapa_activos():
+def cargar_mapa_activos(mtime=None):
     """
     Lee el CSV de infraestructura dentro de la carpeta 'ductos'.
     Ruta esperada: ductos/nombres.csv
+    'mtime' entra en la llave del caché para que una edición del CSV se vuelva a leer.
     """
     carpeta_base = "ductos"
     archivo_infra = os.path.join(carpeta_base, "nombres.csv")
@@ -123,31 +142,31 @@ def cargar_mapa_activos():
         return {"Error": {"Archivo 'ductos/nombres.csv' no encontrado": ""}}
 
     try:
-        # Intentar leer con UTF-8 primero (Estándar moderno)
+        # UTF-8 (estándar moderno) o Latin-1 (ej. Excel antiguo). Se decide antes de leer
+        # porque el motor pyarrow no falla con bytes inválidos: los deja como binario.
+        with open(archivo_infra, 'rb') as f:
+            contenido = f.read()
         try:
-            df_infra = pd.read_csv(archivo_infra, sep=';', encoding='utf-8')
-        except:
-            # Si falla (ej. Excel antiguo), intentar con Latin-1
-            df_infra = pd.read_csv(archivo_infra, sep=';', encoding='latin-1')
-
-        # Iteramos por cada fila del CSV
-        for _, row in df_infra.iterrows():
-            # Limpieza de datos (strip para quitar espacios extra)
-            raw_dist = str(row['DISTRITO']).strip().upper()  
-            nombre_tramo = str(row['TRAMO']).strip()         
-            id_tramo = str(row['ID TRAMO']).strip()          
-            
-            # Formatear nombre del Distrito
-            num_dist = raw_dist.replace('D', '').strip().zfill(2)
-            nombre_distrito = f"Distrito {num_dist}"
-            
+            contenido.decode('utf-8')
+            codificacion = 'utf-8'
+        except UnicodeDecodeError:
+            codificacion = 'latin-1'
+        df_infra = pd.read_csv(io.BytesIO(contenido), sep=';', encoding=codificacion, engine='pyarrow')
+
+        # Limpieza de datos por columna (strip para quitar espacios extra).
+        # Los vacíos quedan como 'nan', igual que str(NaN) en el recorrido fila a fila.
+        df_infra = df_infra[['DISTRITO', 'TRAMO', 'ID TRAMO']].fillna('nan').astype(str)
+        raw_dist = df_infra['DISTRITO'].str.strip().str.upper()
+        nombres_tramo = df_infra['TRAMO'].str.strip()
+        ids_tramo = df_infra['ID TRAMO'].str.strip()
+
+        # Formatear nombre del Distrito
+        nombres_distrito = "Distrito " + raw_dist.str.replace('D', '').str.strip().str.zfill(2)
+
+        for nombre_distrito, nombre_tramo, id_tramo in zip(nombres_distrito, nombres_tramo, ids_tramo):
             # RUTA DEL ARCHIVO GPKG (dentro de carpeta ductos)
-            ruta_gpkg = os.path.join(carpeta_base, f"{id_tramo}")
-            
-            if nombre_distrito not in mapa:
-                mapa[nombre_distrito] = {}
-            
-            mapa[nombre_distrito][nombre_tramo] = ruta_gpkg
+            ruta_gpkg = os.path.join(carpeta_base, id_tramo)
+            mapa.setdefault(nombre_distrito, {})[nombre_tramo] = ruta_gpkg
             
         return dict(sorted(mapa.items()))
         
@@ -156,16 +175,180 @@ def cargar_mapa_activos():
         return {}
 
 # Cargamos el mapa al iniciar la app
-MAPA_DE_ACTIVOS = cargar_mapa_activos()
+RUTA_NOMBRES = os.path.join("ductos", "nombres.csv")
+MAPA_DE_ACTIVOS = cargar_mapa_activos(
+    os.path.getmtime(RUTA_NOMBRES) if os.path.exists(RUTA_NOMBRES) else None
+)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def listar_archivos_ductos(carpeta_ductos="ductos"):
+    """
+    Archivos geo (.gpkg / .shp) de la carpeta de ductos como {nombre en minúsculas: ruta}.
+    Se cachea para no recorrer la carpeta en cada interacción con la barra lateral.
+    """
+    archivos = {}
+    if os.path.exists(carpeta_ductos):
+        for archivo in os.listdir(carpeta_ductos):
+            if archivo.lower().endswith(('.gpkg', '.shp')):
+                archivos[archivo.lower()] = os.path.join(carpeta_ductos, archivo)
+    return archivos
 
 # =========================================================
 #  LÓGICA GEOESPACIAL (PROCESAMIENTO)
 # =========================================================
 
-def procesar_geometria_lrs(df, ruta_activo):
+# Con menos segmentos que esto, GEOS proyecta directo sobre la línea más rápido
+# de lo que cuesta armar y consultar el STRtree
+MIN_SEGMENTOS_ARBOL = 500
+
+@st.cache_resource(show_spinner=False)
+def obtener_transformador(origen, destino):
+    """
+    Transformador pyproj cacheado por par de CRS. Se crea una sola vez por proceso
+    (el script se re-ejecuta en cada interacción, un lru_cache o una variable global
+    se perderían con cada ejecución).
+    """
+    from pyproj import Transformer
+    return Transformer.from_crs(origen, destino, always_xy=True)
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def cargar_linea_ducto(ruta_activo, mtime):
+    """
+    Lee el ducto de referencia y lo unifica en una sola línea (EPSG:3857).
+    Se lee una sola vez por archivo; 'mtime' entra en la llave del caché
+    para que un ducto actualizado en disco se vuelva a leer. Se guardan
+    hasta 32 ductos para acotar la memoria del servidor.
+    Retorna un dict con la línea, su largo y un STRtree sobre sus segmentos
+    (None en ductos cortos), o None si el archivo no tiene líneas válidas.
+    """
+    import geopandas as gpd
+    from shapely.ops import linemerge
+    from shapely.geometry import MultiLineString
+
+    # Solo la geometría: los atributos del ducto no se usan
+    ducto = gpd.read_file(ruta_activo, engine="pyogrio", columns=[])
+
+    # Reproyección directa de las coordenadas a Web Mercator
+    # (un solo llamado a pyproj sobre todos los vértices, sin pasar por to_crs)
+    origen = ducto.crs.to_string() if ducto.crs is not None else "EPSG:4326"
+    t = obtener_transformador(origen, "EPSG:3857")
+    geometrias = shapely.transform(ducto.geometry.values, lambda x, y: t.transform(x, y), interleaved=False)
+
+    # Unificar geometrías: se descomponen las MultiLineString y se conservan solo las líneas
+    # (ids de tipo GEOS: 1 = LineString, 2 = LinearRing, 5 = MultiLineString)
+    tipos = shapely.get_type_id(geometrias)
+    partes = shapely.get_parts(geometrias[np.isin(tipos, (1, 2, 5))])
+    lineas_simples = partes[np.isin(shapely.get_type_id(partes), (1, 2))]
+    
+    if len(lineas_simples) == 0:
+        return None
+
+    merged = linemerge(list(lineas_simples))
+    if isinstance(merged, MultiLineString):
+        linea = max(merged.geoms, key=lambda x: x.length) 
+    else:
+        linea = merged
+
+    # Segmentos individuales (se descartan los de largo cero por vértices repetidos)
+    coords = shapely.get_coordinates(linea)
+    inicio = coords[:-1]
+    vector = coords[1:] - coords[:-1]
+    largo_seg = np.hypot(vector[:, 0], vector[:, 1])
+    pk_inicio = np.concatenate(([0.0], np.cumsum(largo_seg)[:-1]))
+    validos = largo_seg > 0
+    inicio, vector, largo_seg, pk_inicio = inicio[validos], vector[validos], largo_seg[validos], pk_inicio[validos]
+
+    segmentos = shapely.linestrings(np.stack([inicio, inicio + vector], axis=1))
+
+    return {
+        "linea": linea,
+        "largo": linea.length,
+        "arbol": shapely.STRtree(segmentos) if len(segmentos) >= MIN_SEGMENTOS_ARBOL else None,
+        "inicio": inicio,
+        "vector": vector,
+        "largo_seg": largo_seg,
+        "pk_inicio": pk_inicio,
+    }
+
+def proyectar_bloque(ref, puntos):
+    """
+    Busca en el STRtree el segmento más cercano a cada punto y proyecta solo sobre él.
+    Retorna (pk, x_snap, y_snap); los puntos sin resultado (NaN o vacíos) quedan en NaN.
+    """
+    # query_nearest omite los puntos NaN/vacíos: 'entrada' dice a qué punto corresponde cada idx
+    entrada, idx = ref["arbol"].query_nearest(puntos, all_matches=False)
+    xy = shapely.get_coordinates(puntos)[entrada]
+
+    pk = np.full(len(puntos), np.nan)
+    x_snap = np.full(len(puntos), np.nan)
+    y_snap = np.full(len(puntos), np.nan)
+
+    # Con numba la proyección corre compilada y sin GIL (se reparte bien entre hilos).
+    # El kernel no revisa límites: solo recibe los puntos con segmento asignado.
+    if proyectar_en_segmentos is not None:
+        pk[entrada], x_snap[entrada], y_snap[entrada] = proyectar_en_segmentos(
+            xy, idx, ref["inicio"], ref["vector"], ref["largo_seg"], ref["pk_inicio"]
+        )
+        return pk, x_snap, y_snap
+
+    inicio = ref["inicio"][idx]
+    vector = ref["vector"][idx]
+    largo = ref["largo_seg"][idx]
+
+    # Fracción del segmento donde cae la proyección (acotada a sus extremos)
+    frac = ((xy - inicio) * vector).sum(axis=1) / (largo * largo)
+    np.clip(frac, 0.0, 1.0, out=frac)
+
+    pk[entrada] = ref["pk_inicio"][idx] + frac * largo
+    x_snap[entrada] = inicio[:, 0] + frac * vector[:, 0]
+    y_snap[entrada] = inicio[:, 1] + frac * vector[:, 1]
+    return pk, x_snap, y_snap
+
+def proyectar_sobre_ducto(ref, puntos):
+    """
+    Proyecta los puntos sobre el ducto usando el STRtree de segmentos.
+    Retorna (pk, x_snap, y_snap).
+    """
+    if ref["arbol"] is None:
+        # Ducto corto: proyección directa con GEOS sobre la línea completa
+        pk = shapely.line_locate_point(ref["linea"], puntos)
+        snap = shapely.get_coordinates(shapely.line_interpolate_point(ref["linea"], pk))
+        return pk, snap[:, 0], snap[:, 1]
+
+    n_hilos = min(os.cpu_count() or 1, 8)
+    if len(puntos) >= 10000 and n_hilos > 1:
+        # La consulta al STRtree y la proyección liberan el GIL: en levantamientos
+        # grandes se reparten por bloques entre hilos (el árbol ya está construido y solo se lee)
+        bloques = np.array_split(puntos, n_hilos)
+        with ThreadPoolExecutor(max_workers=n_hilos) as ejecutor:
+            resultados = list(ejecutor.map(lambda bloque: proyectar_bloque(ref, bloque), bloques))
+        pk, x_snap, y_snap = (np.concatenate(partes) for partes in zip(*resultados))
+        return pk, x_snap, y_snap
+
+    return proyectar_bloque(ref, puntos)
+
+def extrapolar_borde(x, y, pk_fuera):
+    """
+    Extrapola y(x) hacia PK menores que x[0] (x ordenado y no constante).
+    La recta se ajusta por mínimos cuadrados a los puntos del borde que cubren un
+    tramo de PK igual al extrapolado (como mínimo los dos PK distintos más cercanos):
+    con dos lecturas muy juntas el ruido del GPS definiría solo la pendiente.
+    """
+    tramo = x[0] - pk_fuera.min()
+    n = max(np.searchsorted(x, x[0] + tramo, side="right"), np.searchsorted(x, x[0], side="right") + 1)
+    pendiente, intercepto = np.polyfit(x[:n], y[:n], 1)
+    return pendiente * pk_fuera + intercepto
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def procesar_geometria_lrs(_df, huella_archivo, ruta_activo, mtime):
     """
     Realiza el snapping, cálculo de PK geométrico y corrección de coordenadas.
+    Se cachea por la huella del Excel y el ducto (ruta + mtime), así un nuevo
+    clic en PROCESAR con otros filtros no repite la alineación. El DataFrame
+    ('_df', no se hashea) sale directo del archivo, la huella lo identifica.
+    Se guardan hasta 16 resultados para acotar la memoria del servidor.
     """
+    df = _df
     try:
         # 1. Normalización de Nombres
         df = df.rename(columns={
@@ -175,75 +358,88 @@ def procesar_geometria_lrs(df, ruta_activo):
         })
 
         # 2. Interpolación de Coordenadas Faltantes
+        pk_equipo = df["PK_equipo"].to_numpy(dtype=np.float64)
         for coord in ["Lat", "Long"]:
-            mask = df[coord].isna()
-            if mask.any() and df.loc[~mask].shape[0] > 2:
-                modelo = LinearRegression()
-                modelo.fit(df.loc[~mask, ["PK_equipo"]], df.loc[~mask, coord])
-                df.loc[mask, coord] = modelo.predict(df.loc[mask, ["PK_equipo"]])
+            valores = df[coord].to_numpy(dtype=np.float64, copy=True)
+            mask = np.isnan(valores)
+            validos = ~mask & ~np.isnan(pk_equipo)
+            if mask.any() and validos.any():
+                # Interpolación lineal por PK entre los puntos vecinos con GPS
+                # (con un solo punto válido se repite ese valor)
+                orden = np.argsort(pk_equipo[validos], kind="stable")
+                x, y = pk_equipo[validos][orden], valores[validos][orden]
+                valores[mask] = np.interp(pk_equipo[mask], x, y)
+
+                # Antes del primer y después del último GPS np.interp repetiría el extremo:
+                # ahí se extrapola con una recta ajustada a los puntos del borde
+                if x[0] < x[-1]:
+                    antes = mask & (pk_equipo < x[0])
+                    if antes.any():
+                        valores[antes] = extrapolar_borde(x, y, pk_equipo[antes])
+                    despues = mask & (pk_equipo > x[-1])
+                    if despues.any():
+                        valores[despues] = extrapolar_borde(-x[::-1], y[::-1], -pk_equipo[despues])
+                df[coord] = valores
 
         if df["Lat"].isna().all():
             return df, "Error: No hay coordenadas GPS válidas en el archivo."
             
         # 3. Conversión a Métrico (Web Mercator)
-        t = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
-        df["X"], df["Y"] = t.transform(df["Long"].values, df["Lat"].values)
-
-        gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.X, df.Y), crs=3857)
+        t = obtener_transformador("EPSG:4326", "EPSG:3857")
+        t_back = obtener_transformador("EPSG:3857", "EPSG:4326")
+        xs, ys = t.transform(df["Long"].to_numpy(dtype=np.float64), df["Lat"].to_numpy(dtype=np.float64))
 
         # 4. Carga del Ducto (Referencia)
         try:
-            ducto = gpd.read_file(ruta_activo)
+            ducto_ref = cargar_linea_ducto(ruta_activo, mtime)
         except Exception as e:
             return df, f"Error cargando archivo geo: {str(e)}"
 
-        if ducto.crs is None:
-            ducto = ducto.set_crs(epsg=4326)
-        ducto = ducto.to_crs(3857)
-
-        # Unificar geometrías
-        lineas_simples = []
-        for geom in ducto.geometry:
-            if isinstance(geom, LineString):
-                lineas_simples.append(geom)
-            elif isinstance(geom, MultiLineString):
-                for parte in geom.geoms:
-                    if isinstance(parte, LineString):
-                        lineas_simples.append(parte)
-        
-        if not lineas_simples:
+        if ducto_ref is None:
             return df, "Error: El archivo de referencia no tiene líneas válidas."
-
-        merged = linemerge(lineas_simples)
-        if isinstance(merged, MultiLineString):
-            linea = max(merged.geoms, key=lambda x: x.length) 
-        else:
-            linea = merged
+        largo_linea = ducto_ref["largo"]
 
         # 5. Snap y PK Geométrico
-        gdf["geom_snap"] = gdf.geometry.apply(lambda p: linea.interpolate(linea.project(p)))
-        gdf["PK_geom_m"] = gdf.geometry.apply(lambda p: linea.project(p))
+        # (el STRtree descarta los segmentos lejanos: O(puntos x log segmentos))
+        # Las lecturas con el equipo detenido repiten coordenadas: cada punto distinto
+        # se proyecta una sola vez y el resultado se reparte a sus repeticiones
+        # Las filas que siguen sin coordenadas (sin GPS ni PK del equipo) no se proyectan
+        # y quedan con PK y coordenadas en NaN
+        ubicables = np.isfinite(xs) & np.isfinite(ys)
+        xy = np.column_stack([xs[ubicables], ys[ubicables]])
+        xy_unicos, inversa = np.unique(xy, axis=0, return_inverse=True)
+        if len(xy_unicos) < len(xy):
+            inversa = inversa.ravel()
+            pk_u, x_u, y_u = proyectar_sobre_ducto(ducto_ref, shapely.points(xy_unicos))
+            pk_u, x_u, y_u = pk_u[inversa], x_u[inversa], y_u[inversa]
+        else:
+            pk_u, x_u, y_u = proyectar_sobre_ducto(ducto_ref, shapely.points(xy))
+        pk_geom = np.full(len(df), np.nan)
+        x_snap = np.full(len(df), np.nan)
+        y_snap = np.full(len(df), np.nan)
+        pk_geom[ubicables], x_snap[ubicables], y_snap[ubicables] = pk_u, x_u, y_u
+        df["PK_geom_m"] = pk_geom
 
         # 6. Detección de Sentido
-        df_pk = gdf[["PK_equipo", "PK_geom_m"]].dropna()
-        if len(df_pk) > 5:
-            corr = df_pk["PK_equipo"].corr(df_pk["PK_geom_m"])
-            if corr < 0:
-                gdf["PK_geom_m"] = linea.length - gdf["PK_geom_m"]
+        # Signo de la covarianza entre el PK del equipo y el geométrico (mismo signo que
+        # la correlación) sobre todas las lecturas: un GPS malo en un extremo no invierte el sentido.
+        pk_equipo = df["PK_equipo"].to_numpy(dtype=np.float64)
+        validos = ~np.isnan(pk_equipo) & ~np.isnan(pk_geom)
+        if np.count_nonzero(validos) > 5:
+            x, y = pk_equipo[validos], pk_geom[validos]
+            if np.dot(x - x.mean(), y - y.mean()) < 0:
+                df["PK_geom_m"] = largo_linea - pk_geom
 
         # 7. Lat/Long Corregidas (Retorno a WGS84)
-        t_back = Transformer.from_crs("EPSG:3857", "EPSG:4326", always_xy=True)
-        gdf["Longitude"], gdf["Latitude"] = t_back.transform(
-            gdf["geom_snap"].x.values, gdf["geom_snap"].y.values
-        )
+        df["Longitude"], df["Latitude"] = t_back.transform(x_snap, y_snap)
 
         # 8. Asignar Station No oficial y limpiar
-        gdf["Station No"] = gdf["PK_geom_m"].round(2)
+        df["Station No"] = df["PK_geom_m"].round(2)
         
-        cols_drop = ["X", "Y", "geometry", "geom_snap", "PK_equipo", "Lat", "Long"]
-        gdf = gdf.drop(columns=[c for c in cols_drop if c in gdf.columns], errors='ignore')
+        cols_drop = ["PK_equipo", "Lat", "Long"]
+        df = df.drop(columns=[c for c in cols_drop if c in df.columns], errors='ignore')
 
-        return pd.DataFrame(gdf), None 
+        return df, None 
 
     except Exception as e:
         return df, f"Error interno geoespacial: {str(e)}"
@@ -290,16 +486,16 @@ with st.sidebar:
             
             # ID exacto del tramo que buscamos (Ej: T_OBTU)
             id_buscado = os.path.basename(tramos_dict[ramal_sel])
-            carpeta_ductos = "ductos"
             
             # BÚSQUEDA INTELIGENTE: Ignora mayúsculas/minúsculas y busca la extensión
-            archivo_encontrado = None
-            if os.path.exists(carpeta_ductos):
-                for archivo in os.listdir(carpeta_ductos):
-                    # Comparamos el nombre del archivo en minúsculas
-                    if archivo.lower().startswith(id_buscado.lower()) and archivo.lower().endswith(('.gpkg', '.shp')):
-                        archivo_encontrado = os.path.join(carpeta_ductos, archivo)
-                        break
+            # (primero el nombre exacto, luego cualquier archivo que empiece con el ID)
+            archivos_geo = listar_archivos_ductos()
+            id_min = id_buscado.lower()
+            archivo_encontrado = archivos_geo.get(f"{id_min}.gpkg") or archivos_geo.get(f"{id_min}.shp")
+            if archivo_encontrado is None:
+                archivo_encontrado = next(
+                    (ruta for nombre, ruta in archivos_geo.items() if nombre.startswith(id_min)), None
+                )
             
             if archivo_encontrado:
                 ruta_geo = archivo_encontrado
@@ -327,20 +523,86 @@ with st.sidebar:
         pk_final = st.number_input("PK Final (m)", value=1000.0, step=100.0)
 
 # --- 5. LÓGICA DE PROCESAMIENTO UNIFICADO ---
+# Correcciones ortográficas de comentarios, compiladas en un solo patrón
+CORRECCIONES = {"valvula": "Válvula", "anodo": "Ánodo", "potencial": "Potencial", "estacion": "Estación"}
+PATRON_CORRECCIONES = re.compile("|".join(map(re.escape, CORRECCIONES)))
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def cargar_hojas_excel(file_bytes):
+    """
+    Lee todas las hojas del Excel. Se cachea por el contenido del archivo,
+    así al cambiar los filtros no se vuelve a parsear el libro.
+    Se guardan hasta 16 libros para acotar la memoria del servidor.
+    """
+    # sheet_name=None lee todas las hojas en una sola pasada (conserva el orden del libro)
+    try:
+        return pd.read_excel(io.BytesIO(file_bytes), sheet_name=None, engine="calamine")
+    except ImportError:
+        # Sin python-calamine se usa openpyxl (más lento, mismo resultado)
+        return pd.read_excel(io.BytesIO(file_bytes), sheet_name=None, engine="openpyxl")
+
+def convertir_a_mv(serie):
+    """Convierte una serie de Voltios a mV (x1000, 2 decimales) sobre un solo buffer."""
+    valores = serie.to_numpy(dtype=np.float64, copy=True)
+    np.multiply(valores, 1000.0, out=valores)
+    np.round(valores, 2, out=valores)
+    return valores
+
+def ventana_centrada_bn(funcion, valores, ventana):
+    """
+    Aplica una función móvil de bottleneck (move_median / move_mean) como ventana
+    centrada con min_periods=1, igual que pandas.
+    """
+    # bottleneck alinea la ventana a la derecha: se rellena el final con NaN y se recorta
+    adelante = ventana - 1 - ventana // 2
+    relleno = np.concatenate([valores, np.full(adelante, np.nan)])
+    return funcion(relleno, window=ventana, min_count=1)[adelante:]
+
+def limpiar_columna(valores, umbral, ventana_det, aplicar_smooth, ventana_smooth):
+    """
+    Detección/reemplazo de picos y suavizado de una serie de voltaje (arreglo numpy).
+    Retorna (serie_limpia, cantidad_de_picos).
+    """
+    # Con numba todo el proceso corre en un solo kernel compilado
+    if limpiar_senal is not None:
+        limpio, picos_borrados = limpiar_senal(valores, ventana_det, float(umbral), aplicar_smooth, ventana_smooth)
+        return limpio, int(picos_borrados)
+
+    # Detección de Picos
+    if bn is not None and len(valores) >= ventana_det:
+        mediana_local = ventana_centrada_bn(bn.move_median, valores, ventana_det)
+    else:
+        mediana_local = pd.Series(valores).rolling(window=ventana_det, center=True, min_periods=1).median().to_numpy()
+    
+    # Reemplazar picos (una sola pasada sobre arreglos numpy)
+    es_pico = np.abs(valores - mediana_local) > umbral
+    limpio = valores.copy()
+    np.copyto(limpio, mediana_local, where=es_pico)
+    picos_borrados = int(es_pico.sum())
+    
+    # Suavizado Estético
+    if aplicar_smooth:
+        if bn is not None and len(limpio) >= ventana_smooth:
+            limpio = ventana_centrada_bn(bn.move_mean, limpio, ventana_smooth)
+            np.round(limpio, 2, out=limpio)
+        else:
+            limpio = pd.Series(limpio).rolling(window=ventana_smooth, center=True, min_periods=1).mean().round(2).to_numpy()
+    
+    return limpio, picos_borrados
+
 def procesar_archivo_completo(uploaded_file, ruta_geo, umbral, ventana_det, aplicar_smooth, ventana_smooth):
     log_errores_geo = []
     
     # A. Lectura de todas las hojas
     try:
-        xls = pd.ExcelFile(uploaded_file)
+        contenido = uploaded_file.getvalue()
+        hojas = cargar_hojas_excel(contenido)
+        nombres_hojas = list(hojas)
         # Hoja principal (asumimos index 0)
-        df_survey = pd.read_excel(xls, sheet_name=0) 
+        df_survey = hojas[nombres_hojas[0]]
         
-        # Leer hojas extra para preservarlas
-        hojas_extra = {}
-        for sheet in xls.sheet_names:
-            if sheet != xls.sheet_names[0]:
-                hojas_extra[sheet] = pd.read_excel(xls, sheet_name=sheet)
+        # Hojas extra para preservarlas
+        hojas_extra = {sheet: hojas[sheet] for sheet in nombres_hojas[1:]}
         
         df_dcp = hojas_extra.get('DCP Data', pd.DataFrame())
 
@@ -354,7 +616,8 @@ def procesar_archivo_completo(uploaded_file, ruta_geo, umbral, ventana_det, apli
     if ruta_geo and os.path.exists(ruta_geo):
         with st.status("🗺️ Realizando alineación geoespacial...", expanded=True) as status:
             st.write(f"Procesando contra: {os.path.basename(ruta_geo)}")
-            df_survey, error = procesar_geometria_lrs(df_survey, ruta_geo)
+            huella = hashlib.sha1(contenido).hexdigest()
+            df_survey, error = procesar_geometria_lrs(df_survey, huella, ruta_geo, os.path.getmtime(ruta_geo))
             
             if error:
                 st.warning(f"⚠️ Fallo Geoespacial: {error}. Cambiando a modo manual.")
@@ -373,26 +636,38 @@ def procesar_archivo_completo(uploaded_file, ruta_geo, umbral, ventana_det, apli
         # Voltajes
         for col in ['On Voltage', 'Off Voltage']:
             if col in df_survey.columns:
-                df_survey[col] = (df_survey[col] * 1000).round(2)
+                df_survey[col] = convertir_a_mv(df_survey[col])
         
         # PK Manual
-        if len(df_survey) > 0:
-            df_survey['Station No'] = np.round(np.linspace(pk_inicial, pk_final, len(df_survey)), 3)
+        n_filas = len(df_survey)
+        if n_filas > 0:
+            # Un solo arreglo: rampa lineal construida y redondeada en el mismo buffer
+            paso = (pk_final - pk_inicial) / max(n_filas - 1, 1)
+            station = np.arange(n_filas, dtype=np.float64)
+            station *= paso
+            station += pk_inicial
+            np.round(station, 3, out=station)
+            df_survey['Station No'] = station
         
         # Coords Aleatorias (Simulación visual)
         cols_coords = ['Latitude', 'Longitude']
         if all(col in df_survey.columns for col in cols_coords):
-            np.random.seed(42)
-            aleatorio = np.random.uniform(0, 1, len(df_survey))
+            desplazamiento = np.random.default_rng(42).random(len(df_survey)) * 1e-6
             for col in cols_coords:
-                df_survey[col] = (df_survey[col] + (aleatorio / 1000000)).round(8)
+                df_survey[col] = np.round(df_survey[col].to_numpy(dtype=np.float64) + desplazamiento, 8)
     else:
         # Si fue geoespacial, asegurarnos que voltajes estén en mV
         for col in ['On Voltage', 'Off Voltage']:
             if col in df_survey.columns:
-                # Si promedio es pequeño (<100), asumimos Voltios y convertimos a mV
-                if df_survey[col].abs().mean() < 100: 
-                    df_survey[col] = (df_survey[col] * 1000).round(2)
+                # Si promedio es pequeño (<100), asumimos Voltios y convertimos a mV.
+                # La unidad es la misma en toda la columna: basta con los primeros 1024 datos
+                # (si todos son nulos se revisa la columna completa).
+                valores = df_survey[col].to_numpy(dtype=np.float64)
+                muestra = valores[:1024]
+                if np.isnan(muestra).all():
+                    muestra = valores
+                if np.nanmean(np.abs(muestra)) < 100:
+                    df_survey[col] = convertir_a_mv(df_survey[col])
 
     # D. Integración de Comentarios (DCP)
     col_llave = 'Data No'
@@ -403,44 +678,39 @@ def procesar_archivo_completo(uploaded_file, ruta_geo, umbral, ventana_det, apli
             col_com = df_dcp.columns[6] if len(df_dcp.columns) > 6 else None
             
             if col_com:
+                # Búsqueda directa por diccionario (sin merge ni columna temporal)
                 df_dcp_unica = df_dcp.drop_duplicates(subset=[col_llave], keep='first')
-                df_survey = pd.merge(df_survey, df_dcp_unica[[col_llave, col_com]], on=col_llave, how='left')
+                comentarios = dict(zip(df_dcp_unica[col_llave].to_numpy(), df_dcp_unica[col_com].to_numpy()))
+                comentarios_dcp = df_survey[col_llave].map(comentarios)
                 
                 # Si ya existía columna Comment, rellenar nulos, si no crearla
                 if col_destino in df_survey.columns:
-                    df_survey[col_destino] = df_survey[col_destino].fillna(df_survey[col_com])
+                    df_survey[col_destino] = df_survey[col_destino].fillna(comentarios_dcp)
                 else:
-                    df_survey[col_destino] = df_survey[col_com].fillna('')
-                
-                if col_com != col_destino:
-                    df_survey.drop(columns=[col_com], inplace=True)
+                    df_survey[col_destino] = comentarios_dcp.fillna('')
         except:
             pass
     
-    # E. Corrección Ortográfica
-    correcciones = {"valvula": "Válvula", "anodo": "Ánodo", "potencial": "Potencial", "estacion": "Estación"}
+    # E. Corrección Ortográfica (una sola pasada con el patrón compilado)
     if col_destino in df_survey.columns:
-        for err, corr in correcciones.items():
-            df_survey[col_destino] = df_survey[col_destino].astype(str).str.replace(err, corr, regex=False)
+        # dtype "string" una sola vez: los nulos quedan como <NA> y no como texto 'nan'
+        df_survey[col_destino] = df_survey[col_destino].astype("string").str.replace(
+            PATRON_CORRECCIONES, lambda m: CORRECCIONES[m.group(0)], regex=True
+        )
 
-    # F. Limpieza de Señal (Picos y Suavizado)
+    # F. Limpieza de Señal (Picos y Suavizado), ON y OFF en paralelo
+    cols_voltaje = [col for col in ['On Voltage', 'Off Voltage'] if col in df_survey.columns]
+    series = [df_survey[col].to_numpy(dtype=np.float64) for col in cols_voltaje]
+    with ThreadPoolExecutor(max_workers=2) as ejecutor:
+        resultados = list(ejecutor.map(
+            lambda valores: limpiar_columna(valores, umbral, ventana_det, aplicar_smooth, ventana_smooth),
+            series
+        ))
+    
     log_cambios = {}
-    for col in ['On Voltage', 'Off Voltage']:
-        if col in df_survey.columns:
-            # Detección de Picos
-            mediana_local = df_survey[col].rolling(window=ventana_det, center=True, min_periods=1).median()
-            diferencia = np.abs(df_survey[col] - mediana_local)
-            es_pico = diferencia > umbral
-            
-            # Reemplazar picos
-            df_survey.loc[es_pico, col] = mediana_local[es_pico]
-            picos_borrados = es_pico.sum()
-            
-            # Suavizado Estético
-            if aplicar_smooth:
-                df_survey[col] = df_survey[col].rolling(window=ventana_smooth, center=True, min_periods=1).mean().round(2)
-            
-            log_cambios[col] = picos_borrados
+    for col, (limpio, picos_borrados) in zip(cols_voltaje, resultados):
+        df_survey[col] = limpio
+        log_cambios[col] = picos_borrados
 
     return df_survey, hojas_extra, log_cambios
 
@@ -468,22 +738,40 @@ if archivo is not None:
             st.subheader("📊 Perfil de Potenciales (Vista Previa)")
             
             if 'Station No' in df_final.columns:
-                datos_grafica = df_final[['Station No', 'On Voltage', 'Off Voltage']].melt(
-                    id_vars='Station No', var_name='Tipo', value_name='mV'
-                )
-                
-                scale_colors = alt.Scale(domain=['On Voltage', 'Off Voltage'], range=['#004E98', '#B8233E'])
-                
-                base = alt.Chart(datos_grafica).encode(
-                    x=alt.X('Station No', title='Distancia (m)'),
-                    y=alt.Y('mV', title='Potencial (mV)', scale=alt.Scale(zero=False)),
-                    color=alt.Color('Tipo', scale=scale_colors)
-                )
-                linea = base.mark_line(strokeWidth=2)
-                puntos = base.mark_circle(size=60, opacity=0).encode(tooltip=['Station No', 'mV', 'Tipo'])
+                # Vista previa liviana: float32 y como máximo ~5000 puntos por serie
+                df_plot = df_final[['Station No', 'On Voltage', 'Off Voltage']].astype('float32')
+                paso = -(-len(df_plot) // 5000)
+                if paso > 1:
+                    df_plot = df_plot.iloc[::paso]
                 
-                chart = (linea + puntos).properties(height=500).interactive()
-                st.altair_chart(chart, use_container_width=True)
+                # Especificación Vega-Lite directa (sin pasar por el constructor de Altair).
+                # Los datos viajan en formato ancho: el 'fold' los pasa a largo en el navegador.
+                spec_grafica = {
+                    "height": 500,
+                    "transform": [{"fold": ["On Voltage", "Off Voltage"], "as": ["Tipo", "mV"]}],
+                    "encoding": {
+                        "x": {"field": "Station No", "type": "quantitative", "title": "Distancia (m)"},
+                        "y": {"field": "mV", "type": "quantitative", "title": "Potencial (mV)",
+                              "scale": {"zero": False}},
+                        "color": {"field": "Tipo", "type": "nominal",
+                                  "scale": {"domain": ["On Voltage", "Off Voltage"], "range": ["#004E98", "#B8233E"]}}
+                    },
+                    "layer": [
+                        {
+                            "mark": {"type": "line", "strokeWidth": 2},
+                            "params": [{"name": "zoom", "select": "interval", "bind": "scales"}]
+                        },
+                        {
+                            "mark": {"type": "circle", "size": 60, "opacity": 0},
+                            "encoding": {"tooltip": [
+                                {"field": "Station No", "type": "quantitative", "format": ".2f"},
+                                {"field": "mV", "type": "quantitative", "format": ".2f"},
+                                {"field": "Tipo", "type": "nominal"}
+                            ]}
+                        }
+                    ]
+                }
+                st.vega_lite_chart(df_plot, spec_grafica, use_container_width=True)
                 st.caption("💡 Zoom habilitado con rueda del mouse.")
             
             # Métricas
@@ -492,8 +780,11 @@ if archivo is not None:
             c2.metric("Datos Suavizados (OFF)", log.get('Off Voltage', 0))
             
             # --- GENERACIÓN EXCEL EN BUFFER ---
+            # xlsxwriter escribe más rápido que openpyxl. No se usa 'constant_memory':
+            # pandas escribe por columnas y ese modo descarta las celdas fuera de orden.
             buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+            with pd.ExcelWriter(buffer, engine="xlsxwriter",
+                                engine_kwargs={"options": {"strings_to_urls": False}}) as writer:
                 df_final.to_excel(writer, sheet_name="Survey Data Procesada", index=False)
                 if hojas_guardadas:
                     for nombre_hoja, df_hoja in hojas_guardadas.items():
@@ -0,0 +1,222 @@
+import numpy as np
+from numba import njit
+
+# =========================================================
+#  FILTROS COMPILADOS (NUMBA)
+# =========================================================
+# Este módulo requiere numba. Si no está instalado, el import falla y
+# app_cips.py regresa automáticamente a las funciones de pandas.
+# No se usa fastmath: asume que no hay NaN y rompería su manejo.
+# nogil permite filtrar ON y OFF en hilos paralelos.
+
+
+@njit(cache=True, nogil=True)
+def _subir(vals, ids, pos, i):
+    """Sube el nodo i de un min-heap indexado hasta su lugar."""
+    while i > 0:
+        padre = (i - 1) // 2
+        if vals[padre] <= vals[i]:
+            break
+        vals[padre], vals[i] = vals[i], vals[padre]
+        ids[padre], ids[i] = ids[i], ids[padre]
+        pos[ids[padre]] = padre
+        pos[ids[i]] = i
+        i = padre
+
+
+@njit(cache=True, nogil=True)
+def _bajar(vals, ids, pos, i, n):
+    """Baja el nodo i de un min-heap indexado de tamaño n hasta su lugar."""
+    while True:
+        izq = 2 * i + 1
+        if izq >= n:
+            break
+        menor = izq
+        der = izq + 1
+        if der < n and vals[der] < vals[izq]:
+            menor = der
+        if vals[i] <= vals[menor]:
+            break
+        vals[menor], vals[i] = vals[i], vals[menor]
+        ids[menor], ids[i] = ids[i], ids[menor]
+        pos[ids[menor]] = menor
+        pos[ids[i]] = i
+        i = menor
+
+
+@njit(cache=True, nogil=True)
+def _insertar(vals, ids, pos, n, valor, k):
+    """Inserta el elemento k con su valor. Retorna el nuevo tamaño."""
+    vals[n] = valor
+    ids[n] = k
+    pos[k] = n
+    _subir(vals, ids, pos, n)
+    return n + 1
+
+
+@njit(cache=True, nogil=True)
+def _quitar(vals, ids, pos, n, i):
+    """Quita el nodo en la posición i. Retorna el nuevo tamaño."""
+    ultimo = n - 1
+    k = ids[i]
+    if i != ultimo:
+        vals[i] = vals[ultimo]
+        ids[i] = ids[ultimo]
+        pos[ids[i]] = i
+        _bajar(vals, ids, pos, i, ultimo)
+        _subir(vals, ids, pos, i)
+    pos[k] = -1
+    return ultimo
+
+
+@njit(cache=True, nogil=True)
+def rolling_median_1d(arr, w):
+    """
+    Mediana móvil centrada (equivalente a pandas rolling(w, center=True, min_periods=1)).
+    Usa dos heaps indexados: 'bajo' (max-heap, guardado con signo negativo)
+    y 'alto' (min-heap). Los NaN se ignoran igual que en pandas.
+    """
+    n = arr.shape[0]
+    out = np.empty(n, dtype=np.float64)
+    if n == 0:
+        return out
+
+    atras = w // 2
+    adelante = w - 1 - atras
+
+    bajo_vals = np.empty(w + 1, dtype=np.float64)
+    bajo_ids = np.empty(w + 1, dtype=np.int64)
+    alto_vals = np.empty(w + 1, dtype=np.float64)
+    alto_ids = np.empty(w + 1, dtype=np.int64)
+    pos = np.full(n, -1, dtype=np.int64)
+    lado = np.zeros(n, dtype=np.int8)  # 0 = fuera, 1 = bajo, 2 = alto
+    nb = 0
+    na = 0
+
+    siguiente = 0
+    for i in range(n):
+        # 1. Sale el elemento que quedó atrás de la ventana
+        k = i - atras - 1
+        if k >= 0:
+            if lado[k] == 1:
+                nb = _quitar(bajo_vals, bajo_ids, pos, nb, pos[k])
+            elif lado[k] == 2:
+                na = _quitar(alto_vals, alto_ids, pos, na, pos[k])
+            lado[k] = 0
+
+        # 2. Entran los elementos hasta el borde derecho de la ventana
+        limite = min(n - 1, i + adelante)
+        while siguiente <= limite:
+            x = arr[siguiente]
+            if not np.isnan(x):
+                if nb > 0:
+                    va_abajo = x <= -bajo_vals[0]
+                else:
+                    va_abajo = na == 0 or x <= alto_vals[0]
+                if va_abajo:
+                    nb = _insertar(bajo_vals, bajo_ids, pos, nb, -x, siguiente)
+                    lado[siguiente] = 1
+                else:
+                    na = _insertar(alto_vals, alto_ids, pos, na, x, siguiente)
+                    lado[siguiente] = 2
+            siguiente += 1
+
+        # 3. Rebalanceo: 'bajo' tiene igual o un elemento más que 'alto'
+        while nb > na + 1:
+            k = bajo_ids[0]
+            nb = _quitar(bajo_vals, bajo_ids, pos, nb, 0)
+            na = _insertar(alto_vals, alto_ids, pos, na, arr[k], k)
+            lado[k] = 2
+        while na > nb:
+            k = alto_ids[0]
+            na = _quitar(alto_vals, alto_ids, pos, na, 0)
+            nb = _insertar(bajo_vals, bajo_ids, pos, nb, -arr[k], k)
+            lado[k] = 1
+
+        # 4. Mediana
+        if nb == 0:
+            out[i] = np.nan
+        elif nb > na:
+            out[i] = -bajo_vals[0]
+        else:
+            out[i] = (-bajo_vals[0] + alto_vals[0]) / 2.0
+
+    return out
+
+
+@njit(cache=True, nogil=True)
+def limpiar_senal(arr, ventana_det, umbral, aplicar_smooth, ventana_smooth):
+    """
+    Limpieza completa de una columna en código compilado: mediana móvil,
+    reemplazo de picos y (opcional) media móvil centrada redondeada a 2 decimales.
+    El reemplazo de picos y las sumas acumuladas de la media se hacen en la misma pasada.
+    Retorna (limpio, n_picos).
+    """
+    n = arr.shape[0]
+    mediana = rolling_median_1d(arr, ventana_det)
+    limpio = np.empty(n, dtype=np.float64)
+    suma = np.zeros(n + 1, dtype=np.float64)
+    cuenta = np.zeros(n + 1, dtype=np.int64)
+    n_picos = 0
+
+    # 1. Reemplazo de picos + sumas acumuladas (ignorando NaN, como pandas)
+    for i in range(n):
+        x = arr[i]
+        if abs(x - mediana[i]) > umbral:
+            x = mediana[i]
+            n_picos += 1
+        limpio[i] = x
+        if np.isnan(x):
+            suma[i + 1] = suma[i]
+            cuenta[i + 1] = cuenta[i]
+        else:
+            suma[i + 1] = suma[i] + x
+            cuenta[i + 1] = cuenta[i] + 1
+
+    if not aplicar_smooth:
+        return limpio, n_picos
+
+    # 2. Media móvil centrada (min_periods=1) a partir de las sumas acumuladas
+    atras = ventana_smooth // 2
+    adelante = ventana_smooth - 1 - atras
+    for i in range(n):
+        ini = max(0, i - atras)
+        fin = min(n, i + adelante + 1)
+        c = cuenta[fin] - cuenta[ini]
+        if c == 0:
+            limpio[i] = np.nan
+        else:
+            limpio[i] = np.round((suma[fin] - suma[ini]) / c, 2)
+
+    return limpio, n_picos
+
+
+@njit(cache=True, nogil=True)
+def proyectar_en_segmentos(xy, idx, inicio, vector, largo_seg, pk_inicio):
+    """
+    Proyección analítica de cada punto sobre su segmento más cercano (idx),
+    acotada a los extremos del segmento. Retorna (pk, x_snap, y_snap).
+    'xy' e 'idx' deben tener el mismo largo (numba no revisa los límites).
+    """
+    n = xy.shape[0]
+    if idx.shape[0] != n:
+        raise ValueError("xy e idx deben tener el mismo largo")
+    pk = np.empty(n, dtype=np.float64)
+    x_snap = np.empty(n, dtype=np.float64)
+    y_snap = np.empty(n, dtype=np.float64)
+    for i in range(n):
+        k = idx[i]
+        ax = inicio[k, 0]
+        ay = inicio[k, 1]
+        dx = vector[k, 0]
+        dy = vector[k, 1]
+        largo = largo_seg[k]
+        frac = ((xy[i, 0] - ax) * dx + (xy[i, 1] - ay) * dy) / (largo * largo)
+        if frac < 0.0:
+            frac = 0.0
+        elif frac > 1.0:
+            frac = 1.0
+        pk[i] = pk_inicio[k] + frac * largo
+        x_snap[i] = ax + frac * dx
+        y_snap[i] = ay + frac * dy
+    return pk, x_snap, y_snap